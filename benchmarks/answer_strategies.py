@@ -0,0 +1,56 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from submind import new_answers  # noqa: E402
+
+QUESTION = "What do founders say about finding their first customers?"
+
+
+def make_snippets(count, words):
+    return [" ".join(f"snippet{index}-word{word}" for word in range(words)) for index in range(count)]
+
+
+class StubModel:
+    # Stands in for the answer route: sleeps for the configured latency and echoes a short answer
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, prompt, inputs, default):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.latency)
+        return f"answer {call} to {inputs['question']}"
+
+
+def run(strategy, snippets, latency):
+    model = StubModel(latency)
+    new_answers._invoke = model.invoke
+    new_answers._prompt = lambda system_template, human_template: (system_template, human_template)
+    started = time.monotonic()
+    new_answers.ANSWER_STRATEGIES[strategy](QUESTION, snippets)
+    return time.monotonic() - started, model.calls
+
+
+def main(snippets: int = typer.Option(16, help="Number of snippets to answer from"),
+         words: int = typer.Option(200, help="Words per snippet"),
+         latency: float = typer.Option(0.5, help="Seconds each stub model call takes"),
+         concurrency: int = typer.Option(new_answers.ANSWER_CONCURRENCY, help="Workers for the tree strategy")):
+    new_answers.ANSWER_CONCURRENCY = concurrency
+    snippet_set = make_snippets(snippets, words)
+    print(f"{snippets} snippets, {latency}s per call, tree concurrency {concurrency}")
+    for strategy in new_answers.ANSWER_STRATEGIES:
+        seconds, calls = run(strategy, snippet_set, latency)
+        print(f"{strategy:>5}: {seconds:.2f}s wall, {calls} model calls")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -4,13 +4,16 @@ from typing import Optional
 
 import typer
 from decouple import config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, or_
 from sqlalchemy.orm import sessionmaker
 
+from submind.documents import ensure_document_indexes
+from submind.leases import LEASES_ENABLED, ensure_lease_table
+from submind.listener import PendingThoughtListener, install_notify_trigger, notify_trigger_installed
 from submind.models import Submind, SubmindSchedule, User
-from submind.new_answers import pull_new_answers
-from submind.research import update_research
-from submind.twitter_style import twitter_style_submind_run
+from submind.new_answers import ensure_answer_schema, install_answer_indexes, pending_answers_by_submind, pull_new_answers
+from submind.runner import run_subminds
+from submind.scheduler import SubmindScheduler
 
 class Schedule(str, Enum):
     instant = "now"
@@ -19,45 +22,110 @@ class Schedule(str, Enum):
     daily = "daily"
 
 
-def main(schedule: Optional[Schedule] = typer.Option(Schedule.daily)):
+SUBMIND_SCHEDULES = {
+    Schedule.daily: SubmindSchedule.DAILY,
+    Schedule.eight_hour: SubmindSchedule.EIGHT_HOUR,
+    Schedule.four_hour: SubmindSchedule.FOUR_HOUR,
+    Schedule.instant: SubmindSchedule.INSTANT,
+}
+
+
+# Stage modules pull in langchain and friends, so they are imported only once there is work for them
+def run_submind(session, submind):
+    if submind.pendingThoughts:
+        from submind.twitter_style import twitter_style_submind_run
+
+        print(f"Running submind {submind.id} for user {submind.ownerId}")
+        twitter_style_submind_run(submind, session)
+    submind.lastRun = datetime.now()
+    session.add(submind)
+    session.commit()
+
+
+def poll_answers(Session, workers):
+    from submind.research import update_research
+
+    session = Session()
+    try:
+        # Only subminds with outstanding podcast requests are polled
+        pending = pending_answers_by_submind(session)
+        run_subminds(Session, list(pending),
+                     lambda worker_session, submind: pull_new_answers(worker_session, submind, pending[submind.id]),
+                     workers)
+        update_research(session)
+    finally:
+        session.close()
+
+
+def instant_submind_ids(session):
+    rows = session.query(Submind.id).outerjoin(User, Submind.ownerId == User.id).filter(
+        or_(Submind.schedule == SubmindSchedule.INSTANT, User.instantAccessUntil > datetime.now())).all()
+    return [submind_id for (submind_id,) in rows]
+
+
+def instant_catch_up(Session):
+    session = Session()
+    try:
+        return instant_submind_ids(session)
+    finally:
+        session.close()
+
+
+def listen_forever(Session, listener, workers):
+    while True:
+        submind_ids = listener.wait(None)
+        run_subminds(Session, submind_ids, run_submind, workers)
+
+
+def main(schedule: Optional[Schedule] = typer.Option(Schedule.daily),
+         workers: int = typer.Option(1, help="Number of subminds to run concurrently"),
+         serve: bool = typer.Option(False, help="Stay resident and run each submind when it is due"),
+         listen: bool = typer.Option(False, help="Run INSTANT subminds as soon as a thought is queued for them"),
+         install_schema: bool = typer.Option(False, help="Create the runner's index and notify trigger on the app's tables")):
     # Replace 'database_url' with your actual database connection URL
     database_url = config('DATABASE_URL')
-    engine = create_engine(database_url)
+    engine = create_engine(database_url, pool_size=max(5, workers))
+
+    ensure_answer_schema(engine)
+    if install_schema:
+        install_answer_indexes(engine)
+        install_notify_trigger(engine)
+    ensure_document_indexes()
+    if LEASES_ENABLED:
+        ensure_lease_table(engine)
 
     Session = sessionmaker(bind=engine)
-    session = Session()
-    subminds = session.query(Submind).all()
 
-    for submind in subminds:
-        pull_new_answers(session, submind)
+    listener = None
+    if listen:
+        if not notify_trigger_installed(engine):
+            print("The pending thought trigger isn't installed; run once with --install-schema to get notifications")
+        listener = PendingThoughtListener(engine, catch_up=lambda: instant_catch_up(Session))
+
+    if serve:
+        scheduler = SubmindScheduler(Session, run_submind, workers, poll=lambda: poll_answers(Session, workers),
+                                     listener=listener)
+        scheduler.run_forever()
+        return
 
-    update_research(session)
+    poll_answers(Session, workers)
     # Now you can query for all Submind records with 'ACTIVE' status
 
-    if schedule == Schedule.daily:
-
-        all_subminds = session.query(Submind).filter(Submind.schedule == SubmindSchedule.DAILY).all()
-        for submind in all_subminds:
-            twitter_style_submind_run(submind, session)
-
-    elif schedule == Schedule.eight_hour:
-        all_subminds = session.query(Submind).filter(Submind.schedule == SubmindSchedule.EIGHT_HOUR).all()
-        for submind in all_subminds:
-            twitter_style_submind_run(submind, session)
-
-    elif schedule == Schedule.four_hour:
-        all_subminds = session.query(Submind).filter(Submind.schedule == SubmindSchedule.FOUR_HOUR).all()
-        for submind in all_subminds:
-            twitter_style_submind_run(submind, session)
-
-    elif schedule == Schedule.instant:
-        all_subminds = session.query(Submind).filter(Submind.schedule == SubmindSchedule.INSTANT).all()
-        current_access = session.query(User).filter(User.instantAccessUntil > datetime.now()).all()
-        for user in current_access:
-            all_subminds.extend(session.query(Submind).filter(Submind.ownerId == user.id).all())
-        for submind in all_subminds:
-            print(f"Running submind {submind.id} for user {submind.ownerId}")
-            twitter_style_submind_run(submind, session)
+    session = Session()
+    if schedule == Schedule.instant:
+        submind_ids = instant_submind_ids(session)
+    else:
+        all_subminds = session.query(Submind.id).filter(Submind.schedule == SUBMIND_SCHEDULES[schedule]).all()
+        submind_ids = [submind_id for (submind_id,) in all_subminds]
+    session.close()
+
+    run_subminds(Session, submind_ids, run_submind, workers)
+
+    if listener:
+        if schedule != Schedule.instant:
+            # Catch up on thoughts that were queued before the listener started
+            run_subminds(Session, instant_catch_up(Session), run_submind, workers)
+        listen_forever(Session, listener, workers)
 
 
 if __name__ == "__main__":
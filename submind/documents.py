@@ -1,74 +1,387 @@
+import asyncio
+import json
+import threading
 import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from datetime import datetime
+from difflib import SequenceMatcher
 
 from decouple import config
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, ReturnDocument, UpdateOne
 
+# Every Nth version in document_history is stored in full; the rest are deltas against the next version
+HISTORY_SNAPSHOT_INTERVAL = max(1, config('HISTORY_SNAPSHOT_INTERVAL', default=20, cast=int))
 
-def get_document(document_uuid, user_id):
-    mongo_client = MongoClient(config('MONGODB_CONNECTION_STRING'))
-    db = mongo_client.myaicofounder
-    existing_doc = db.documents.find_one({"uuid": document_uuid, "userId": user_id})
-    if not existing_doc:
-        db.documents.insert_one({
-            "userId": user_id,
-            "content": "",
-            "uuid": document_uuid,
-            "createdAt": datetime.now()
-        })
-        existing_doc = db.documents.find_one({"uuid": document_uuid, "userId": user_id})
-    return existing_doc
+DOCUMENT_UPDATE_ATTEMPTS = 5
 
-def update_document(document_uuid, content):
-    mongo_client = MongoClient(config('MONGODB_CONNECTION_STRING'))
-    db = mongo_client.myaicofounder
-    historical_uuid = str(uuid.uuid4())
-    previous_doc = db.documents.find_one({"uuid": document_uuid})
-
-    db.document_history.insert_one({
-        "uuid": historical_uuid,
-        "content": previous_doc["content"],
-        "createdAt": previous_doc["createdAt"],
-        "documentUUID": previous_doc["uuid"]
-    })
-    db.documents.update_one({"uuid": document_uuid}, {"$set": {"content": content, "previousVersion": historical_uuid, "updatedAt": datetime.now()}})
+_mongo_client = None
+_document_loop = None
+_document_loop_lock = threading.Lock()
+# uuid -> document for the current run; None outside of document_cache()
+_run_documents = ContextVar('run_documents', default=None)
 
-def create_document(user_id, content, uuid):
-    mongo_client = MongoClient(config('MONGODB_CONNECTION_STRING'))
-    db = mongo_client.myaicofounder
+# Submind fields holding the context document uuids, and the content a missing document starts with
+CONTEXT_DOCUMENTS = {
+    "founder": ("founderUUID", "You don't know anything about the founder yet"),
+    "values": ("valuesUUID", "You don't know anything about the founder's values yet"),
+    "mind": ("mindUUID", "You don't know anything about the founder's mind yet"),
+}
+
+
+@dataclass
+class SubmindContext:
+    founder: str
+    values: str
+    mind: str
+
+    def as_prompt_inputs(self):
+        return {"founder": self.founder, "values": self.values, "mind": self.mind}
+
+
+def _loop():
+    # All document I/O runs on one background event loop that owns the shared AsyncMongoClient, so sync
+    # callers on worker threads and async callers on their own loops share one connection pool
+    global _document_loop
+    with _document_loop_lock:
+        if _document_loop is None:
+            _document_loop = asyncio.new_event_loop()
+            threading.Thread(target=_document_loop.run_forever, name="documents", daemon=True).start()
+    return _document_loop
+
+
+def get_async_db():
+    # Only usable from coroutines running on the document loop
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = AsyncMongoClient(config('MONGODB_CONNECTION_STRING'))
+    return _mongo_client.myaicofounder
+
+
+async def _with_run_documents(coroutine, documents):
+    # Tasks on the document loop don't inherit the caller's context, so the run cache is carried over
+    _run_documents.set(documents)
+    return await coroutine
+
+
+def _run(coroutine):
+    future = asyncio.run_coroutine_threadsafe(_with_run_documents(coroutine, _run_documents.get()), _loop())
+    return future.result()
+
+
+async def _run_async(coroutine):
+    loop = _loop()
+    if asyncio.get_running_loop() is loop:
+        return await coroutine
+    future = asyncio.run_coroutine_threadsafe(_with_run_documents(coroutine, _run_documents.get()), loop)
+    return await asyncio.wrap_future(future)
+
+
+@contextmanager
+def document_cache():
+    # Read-through cache of documents for the duration of a run; nested uses share the outer cache
+    if _run_documents.get() is not None:
+        yield
+        return
+    token = _run_documents.set({})
+    try:
+        yield
+    finally:
+        _run_documents.reset(token)
+
+
+def _cached_document(document_uuid, user_id):
+    documents = _run_documents.get()
+    if documents is None:
+        return None
+    doc = documents.get(document_uuid)
+    if doc and doc["userId"] == user_id:
+        return doc
+    return None
+
+
+def _cache_document(doc):
+    documents = _run_documents.get()
+    if documents is not None:
+        documents[doc["uuid"]] = doc
+    return doc
+
+
+def _invalidate_document(document_uuid):
+    documents = _run_documents.get()
+    if documents is not None:
+        documents.pop(document_uuid, None)
+
+
+async def _ensure_document_indexes():
+    # Idempotent; run on startup so lookups stay indexed as the collections grow. The uuid/userId index
+    # isn't unique since existing collections may hold duplicates, so concurrent upserts can still
+    # occasionally insert the same document twice
+    db = get_async_db()
+    await db.documents.create_index([("uuid", ASCENDING), ("userId", ASCENDING)])
+    await db.documents.create_index([("userId", ASCENDING)])
+    await db.document_history.create_index([("documentUUID", ASCENDING), ("version", ASCENDING)])
+
+
+async def _get_document(document_uuid, user_id):
+    cached = _cached_document(document_uuid, user_id)
+    if cached:
+        return cached
+    db = get_async_db()
+    existing_doc = await db.documents.find_one_and_update(
+        {"uuid": document_uuid, "userId": user_id},
+        {"$setOnInsert": {"content": "", "createdAt": datetime.now()}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    return _cache_document(existing_doc)
+
+
+def _history_delta(newer, older):
+    # Ops that rebuild `older` from the lines of `newer`: ["c", i, j] copies newer's lines i:j, ["i", text] inserts text
+    newer_lines = newer.splitlines(keepends=True)
+    older_lines = older.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, newer_lines, older_lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            delta.append(["c", i1, i2])
+        elif tag in ("replace", "insert"):
+            delta.append(["i", "".join(older_lines[j1:j2])])
+    return delta
+
+
+def _apply_history_delta(newer, delta):
+    newer_lines = newer.splitlines(keepends=True)
+    return "".join("".join(newer_lines[op[1]:op[2]]) if op[0] == "c" else op[1] for op in delta)
+
+
+async def _update_document(document_uuid, content):
+    db = get_async_db()
+    for _ in range(DOCUMENT_UPDATE_ATTEMPTS):
+        previous_doc = await db.documents.find_one({"uuid": document_uuid})
+        if not previous_doc:
+            print(f"Document {document_uuid} does not exist")
+            return
+
+        # The previous version goes into the history before the document is overwritten, so a crash in
+        # between never loses it. Entries link back through previousVersion; one left behind by an update
+        # that never landed isn't on that chain and is ignored by get_document_version
+        version = previous_doc.get("version", 0)
+        historical_uuid = str(uuid.uuid4())
+        history = {
+            "uuid": historical_uuid,
+            "createdAt": previous_doc["createdAt"],
+            "documentUUID": previous_doc["uuid"],
+            "version": version,
+            "previousVersion": previous_doc.get("previousVersion"),
+        }
+        delta = _history_delta(content, previous_doc["content"])
+        if version % HISTORY_SNAPSHOT_INTERVAL == 0 or len(json.dumps(delta)) >= len(previous_doc["content"]):
+            history["content"] = previous_doc["content"]
+        else:
+            history["delta"] = delta
+        await db.document_history.insert_one(history)
+
+        # Only applies if nobody else updated the document since we read it
+        updated = await db.documents.update_one(
+            {"uuid": document_uuid, "version": version if "version" in previous_doc else {"$exists": False}},
+            {"$set": {"content": content, "previousVersion": historical_uuid, "updatedAt": datetime.now()},
+             "$inc": {"version": 1}})
+        _invalidate_document(document_uuid)
+        if updated.modified_count:
+            return
+        await db.document_history.delete_one({"uuid": historical_uuid})
+    print(f"Document {document_uuid} kept changing; gave up updating it after {DOCUMENT_UPDATE_ATTEMPTS} attempts")
+
+
+async def _get_document_version(document_uuid, version):
+    # Walks back from the nearest newer snapshot (or the live document) applying deltas down to `version`
+    db = get_async_db()
+    current = await db.documents.find_one({"uuid": document_uuid})
+    if not current:
+        return None
+    if version >= current.get("version", 0):
+        return current["content"]
+
+    # A full copy is right whichever update wrote it, since it was read at that exact version
+    snapshot = await db.document_history.find_one(
+        {"documentUUID": document_uuid, "version": {"$gte": version}, "content": {"$exists": True}},
+        sort=[("version", ASCENDING)])
+    source = snapshot or current
+    content, newest, next_uuid = source["content"], source.get("version", 0), source.get("previousVersion")
+
+    entries = await db.document_history.find(
+        {"documentUUID": document_uuid, "version": {"$gte": version, "$lt": newest}}).to_list()
+    by_uuid = {entry["uuid"]: entry for entry in entries}
+    while newest > version:
+        # Deltas are only trusted on the previousVersion chain; a stray full copy can fill a gap in it
+        entry = by_uuid.get(next_uuid)
+        if not entry or entry["version"] != newest - 1:
+            entry = next((entry for entry in entries if entry["version"] == newest - 1 and "content" in entry),
+                         None)
+        if not entry:
+            print(f"History for document {document_uuid} is missing version {newest - 1}")
+            return None
+        content = entry["content"] if "content" in entry else _apply_history_delta(content, entry["delta"])
+        next_uuid = entry.get("previousVersion")
+        newest -= 1
+    return content
+
+
+async def _create_document(user_id, content, uuid):
+    db = get_async_db()
     new_doc = {
         "userId": user_id,
         "content": content,
         "uuid": uuid,
         "createdAt": datetime.now()
     }
-    db.documents.insert_one(new_doc)
-    return new_doc
+    await db.documents.insert_one(new_doc)
+    return _cache_document(new_doc)
 
-def create_report(user_id, content, uuid):
-    mongo_client = MongoClient(config('MONGODB_CONNECTION_STRING'))
-    db = mongo_client.myaicofounder
+async def _create_report(user_id, content, uuid):
+    db = get_async_db()
     new_report = {
         "userId": user_id,
         "content": content,
         "uuid": uuid,
         "createdAt": datetime.now()
     }
-    db.reports.insert_one(new_report)
+    await db.reports.insert_one(new_report)
     return new_report
 
+async def _get_or_create_document(user_id, content, uuid):
+    cached = _cached_document(uuid, user_id)
+    if cached:
+        return cached
+    db = get_async_db()
+    existing_doc = await db.documents.find_one_and_update(
+        {"userId": user_id, "uuid": uuid},
+        {"$setOnInsert": {"content": content, "createdAt": datetime.now()}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    return _cache_document(existing_doc)
+
+
+async def _load_submind_contexts(subminds):
+    # Fetches the founder, values and mind documents of every submind with one $in query,
+    # creating any that don't exist yet
+    wanted = {}
+    for submind in subminds:
+        wanted[submind.id] = {}
+        for name, (field, _) in CONTEXT_DOCUMENTS.items():
+            if not getattr(submind, field):
+                # saved on the submind (with the caller's next commit) so later runs reuse the same document
+                setattr(submind, field, str(uuid.uuid4()))
+            wanted[submind.id][name] = getattr(submind, field)
+
+    docs = {}
+    to_fetch = set()
+    for submind in subminds:
+        for doc_uuid in wanted[submind.id].values():
+            cached = _cached_document(doc_uuid, submind.ownerId)
+            if cached:
+                docs[(doc_uuid, submind.ownerId)] = cached
+            else:
+                to_fetch.add(doc_uuid)
+
+    db = get_async_db()
+    if to_fetch:
+        async for doc in db.documents.find({"uuid": {"$in": list(to_fetch)}}):
+            docs[(doc["uuid"], doc["userId"])] = _cache_document(doc)
+
+    upserts = []
+    for submind in subminds:
+        for name, doc_uuid in wanted[submind.id].items():
+            if (doc_uuid, submind.ownerId) not in docs:
+                new_doc = {
+                    "userId": submind.ownerId,
+                    "content": CONTEXT_DOCUMENTS[name][1],
+                    "uuid": doc_uuid,
+                    "createdAt": datetime.now()
+                }
+                docs[(doc_uuid, submind.ownerId)] = _cache_document(new_doc)
+                upserts.append(UpdateOne({"uuid": doc_uuid, "userId": submind.ownerId},
+                                         {"$setOnInsert": {"content": new_doc["content"],
+                                                           "createdAt": new_doc["createdAt"]}},
+                                         upsert=True))
+    if upserts:
+        await db.documents.bulk_write(upserts, ordered=False)
+
+    return {submind.id: SubmindContext(**{name: docs[(doc_uuid, submind.ownerId)]["content"]
+                                          for name, doc_uuid in wanted[submind.id].items()})
+            for submind in subminds}
+
+
+# Each call runs on the document loop: the a-prefixed coroutines can be awaited from any event loop,
+# the plain functions block the calling thread until the loop is done with them
+
+
+def ensure_document_indexes():
+    return _run(_ensure_document_indexes())
+
+
+async def aensure_document_indexes():
+    return await _run_async(_ensure_document_indexes())
+
+
+def get_document(document_uuid, user_id):
+    return _run(_get_document(document_uuid, user_id))
+
+
+async def aget_document(document_uuid, user_id):
+    return await _run_async(_get_document(document_uuid, user_id))
+
+
+def update_document(document_uuid, content):
+    return _run(_update_document(document_uuid, content))
+
+
+async def aupdate_document(document_uuid, content):
+    return await _run_async(_update_document(document_uuid, content))
+
+
+def get_document_version(document_uuid, version):
+    return _run(_get_document_version(document_uuid, version))
+
+
+async def aget_document_version(document_uuid, version):
+    return await _run_async(_get_document_version(document_uuid, version))
+
+
+def create_document(user_id, content, uuid):
+    return _run(_create_document(user_id, content, uuid))
+
+
+async def acreate_document(user_id, content, uuid):
+    return await _run_async(_create_document(user_id, content, uuid))
+
+
+def create_report(user_id, content, uuid):
+    return _run(_create_report(user_id, content, uuid))
+
+
+async def acreate_report(user_id, content, uuid):
+    return await _run_async(_create_report(user_id, content, uuid))
+
+
 def get_or_create_document(user_id, content, uuid):
-    mongo_client = MongoClient(config('MONGODB_CONNECTION_STRING'))
-    db = mongo_client.myaicofounder
-    existing_doc = db.documents.find_one({"userId": user_id, "uuid": uuid})
-    if existing_doc:
-        return existing_doc
-    else:
-        new_doc = {
-            "userId": user_id,
-            "content": content,
-            "uuid": uuid,
-            "createdAt": datetime.now()
-        }
-        db.documents.insert_one(new_doc)
-        return new_doc
\ No newline at end of file
+    return _run(_get_or_create_document(user_id, content, uuid))
+
+
+async def aget_or_create_document(user_id, content, uuid):
+    return await _run_async(_get_or_create_document(user_id, content, uuid))
+
+
+def load_submind_contexts(subminds):
+    return _run(_load_submind_contexts(subminds))
+
+
+async def aload_submind_contexts(subminds):
+    return await _run_async(_load_submind_contexts(subminds))
+
+
+def load_submind_context(submind):
+    return load_submind_contexts([submind])[submind.id]
+
+
+async def aload_submind_context(submind):
+    return (await aload_submind_contexts([submind]))[submind.id]
@@ -1,11 +1,10 @@
 import uuid
 
-from decouple import config
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 
 from submind.documents import create_report
+from submind.llm import GPT_4_ROUTE, router
 
 
 def final_run(session, submind, document, mind, ):
@@ -23,14 +22,13 @@ def final_run(session, submind, document, mind, ):
 
     """
 
-    model = ChatOpenAI(model="gpt-4", openai_api_key=config("OPENAI_API_KEY"))
     prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
     output_parser = StrOutputParser()
-    chain = prompt | model | output_parser
-    report = chain.invoke({"submind_name": submind.name, "submind_description": submind.description,
-                           "submind_document": document,
-                           "submind_mind": mind, "related_thoughts": "\n".join(
-            map(lambda x: x.content, submind.relatedThoughts))})
+    report = router.invoke(GPT_4_ROUTE, lambda model: prompt | model | output_parser,
+                           {"submind_name": submind.name, "submind_description": submind.description,
+                            "submind_document": document,
+                            "submind_mind": mind, "related_thoughts": "\n".join(
+                               map(lambda x: x.content, submind.relatedThoughts))})
     print(report)
     create_report(submind.ownerId, report, str(uuid.uuid4()))
     submind.status = "COMPLETED"
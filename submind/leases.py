@@ -0,0 +1,109 @@
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from decouple import config
+from sqlalchemy import func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from submind.models import Lease, Submind, Thought, pending_thoughts_table
+
+LEASES_ENABLED = config('SUBMIND_LEASES', default=False, cast=bool)
+LEASE_SECONDS = config('LEASE_SECONDS', default=900, cast=int)
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_owner():
+    # Per thread, so two workers in the same process can't both hold a lease
+    return f"{NODE_ID}:{threading.get_ident()}"
+
+
+def ensure_lease_table(engine):
+    Lease.__table__.create(engine, checkfirst=True)
+
+
+def submind_resource(submind_id):
+    return f"submind:{submind_id}"
+
+
+def thought_resource(submind_id, thought_id):
+    return f"thought:{submind_id}:{thought_id}"
+
+
+def _claim(session, resource, ttl):
+    # Takes the lease if nobody holds it, it has expired, or we already hold it (renewal)
+    stmt = insert(Lease).values(resource=resource, owner=lease_owner(),
+                                expiresAt=func.now() + timedelta(seconds=ttl))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Lease.resource],
+        set_={"owner": stmt.excluded.owner, "expiresAt": stmt.excluded.expiresAt},
+        where=or_(Lease.expiresAt < func.now(), Lease.owner == stmt.excluded.owner),
+    ).returning(Lease.resource)
+    return session.execute(stmt).first() is not None
+
+
+def claim(session, resource, ttl=LEASE_SECONDS):
+    claimed = _claim(session, resource, ttl)
+    session.commit()
+    return claimed
+
+
+def release(session, *resources):
+    session.query(Lease).filter(Lease.resource.in_(resources), Lease.owner == lease_owner()).delete(
+        synchronize_session=False)
+    session.commit()
+
+
+def renew(session, owner=None, ttl=LEASE_SECONDS):
+    # Extends every lease the owner still holds; leases taken over by someone else are left alone
+    renewed = session.query(Lease).filter(Lease.owner == (owner or lease_owner())).update(
+        {Lease.expiresAt: func.now() + timedelta(seconds=ttl)}, synchronize_session=False)
+    session.commit()
+    return renewed
+
+
+@contextmanager
+def lease_heartbeat(engine, interval=None, ttl=LEASE_SECONDS):
+    # Renews the calling worker's leases from a background thread so a run longer than the ttl keeps them
+    owner = lease_owner()
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval or ttl / 3):
+            try:
+                with Session(engine) as session:
+                    renew(session, owner, ttl)
+            except Exception as e:
+                print(f"Failed to renew leases for {owner}")
+                print(e)
+
+    thread = threading.Thread(target=beat, name=f"lease-heartbeat-{owner}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def claim_submind(session, submind_id, ttl=LEASE_SECONDS):
+    # Lock the row while claiming so concurrent nodes skip it instead of racing on the lease
+    locked = session.execute(
+        select(Submind.id).where(Submind.id == submind_id).with_for_update(skip_locked=True)).first()
+    claimed = locked is not None and _claim(session, submind_resource(submind_id), ttl)
+    session.commit()
+    return claimed
+
+
+def claim_pending_thoughts(session, submind, ttl=LEASE_SECONDS):
+    rows = session.execute(
+        select(pending_thoughts_table.c.B).where(pending_thoughts_table.c.A == submind.id)
+        .order_by(pending_thoughts_table.c.B).with_for_update(skip_locked=True)).all()
+    thought_ids = [thought_id for (thought_id,) in rows if _claim(session, thought_resource(submind.id, thought_id), ttl)]
+    session.commit()
+    if not thought_ids:
+        return []
+    return session.query(Thought).filter(Thought.id.in_(thought_ids)).order_by(Thought.id).all()
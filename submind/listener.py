@@ -0,0 +1,94 @@
+import select
+import time
+
+import psycopg2
+from decouple import config
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+CHANNEL = 'submind_pending_thought'
+LISTEN_RECONNECT_SECONDS = config('LISTEN_RECONNECT_SECONDS', default=5, cast=float)
+
+# Only subminds that should react instantly notify: INSTANT schedule, or an owner with instant access
+NOTIFY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION submind_pending_thought_notify() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM "Submind" s LEFT JOIN "User" u ON u.id = s."ownerId"
+        WHERE s.id = NEW."A" AND (s.schedule = 'INSTANT' OR u."instantAccessUntil" > now())
+    ) THEN
+        PERFORM pg_notify('submind_pending_thought', NEW."A"::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+DROP_TRIGGER_SQL = 'DROP TRIGGER IF EXISTS submind_pending_thought_notify ON "_SubmindPendingThoughts"'
+
+CREATE_TRIGGER_SQL = """
+CREATE TRIGGER submind_pending_thought_notify AFTER INSERT ON "_SubmindPendingThoughts"
+FOR EACH ROW EXECUTE FUNCTION submind_pending_thought_notify()
+"""
+
+
+def install_notify_trigger(engine):
+    with engine.begin() as connection:
+        connection.execute(text(NOTIFY_FUNCTION_SQL))
+        connection.execute(text(DROP_TRIGGER_SQL))
+        connection.execute(text(CREATE_TRIGGER_SQL))
+
+
+def notify_trigger_installed(engine):
+    with engine.connect() as connection:
+        return connection.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'submind_pending_thought_notify' AND NOT tgisinternal")
+        ).first() is not None
+
+
+class PendingThoughtListener:
+    def __init__(self, engine, catch_up=None):
+        # catch_up returns the submind ids to run after a reconnect, for notifications missed while disconnected
+        self.engine = engine
+        self.catch_up = catch_up
+        self.connection = None
+        self.connect()
+
+    def connect(self):
+        self.connection = self.engine.raw_connection()
+        # keep the LISTEN connection out of the pool; it is closed rather than reused
+        self.connection.detach()
+        self.dbapi_connection = self.connection.driver_connection
+        self.dbapi_connection.autocommit = True
+        with self.dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+
+    def wait(self, timeout):
+        # Returns the ids of subminds that received a pending thought, or [] on timeout
+        try:
+            if self.connection is None:
+                self.connect()
+                print("Reconnected to listen for pending thoughts")
+                return sorted(self.catch_up()) if self.catch_up else []
+            if select.select([self.dbapi_connection], [], [], timeout) == ([], [], []):
+                return []
+            self.dbapi_connection.poll()
+        except (psycopg2.Error, DBAPIError, OSError) as e:
+            print("Lost the connection listening for pending thoughts")
+            print(e)
+            self.close()
+            time.sleep(LISTEN_RECONNECT_SECONDS if timeout is None else min(timeout, LISTEN_RECONNECT_SECONDS))
+            return []
+        submind_ids = set()
+        while self.dbapi_connection.notifies:
+            notify = self.dbapi_connection.notifies.pop(0)
+            submind_ids.add(int(notify.payload))
+        return sorted(submind_ids)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
@@ -0,0 +1,222 @@
+import json
+import threading
+import time
+
+from decouple import Csv, config
+
+CIRCUIT_FAILURE_THRESHOLD = config('CIRCUIT_FAILURE_THRESHOLD', default=3, cast=int)
+CIRCUIT_RESET_SECONDS = config('CIRCUIT_RESET_SECONDS', default=60, cast=float)
+# Models slower than this on average drop behind the rest of their route
+SLOW_MODEL_SECONDS = config('SLOW_MODEL_SECONDS', default=30, cast=float)
+# How long it takes a model's recorded latency to halve when it isn't being called, so a demoted model gets retried
+LATENCY_HALF_LIFE_SECONDS = config('LATENCY_HALF_LIFE_SECONDS', default=600, cast=float)
+
+ANSWER_ROUTE = ("claude-3-haiku-20240307", "gpt-3.5-turbo", "gpt-4-turbo")
+GPT_4_ROUTE = ("gpt-4",)
+# Models for prompts opening with CONTEXT_PREFIX, in order. The gpt-4 default keeps the original model but
+# gets no prompt cache hits; gpt-4o serves repeated prefixes of 1024+ tokens from OpenAI's cache, e.g.
+# CONTEXT_MODELS=gpt-4o,gpt-4
+CONTEXT_ROUTE = config('CONTEXT_MODELS', default='gpt-4', cast=Csv(post_process=tuple))
+
+
+def _anthropic(model_name):
+    from langchain_anthropic import ChatAnthropic
+
+    return ChatAnthropic(model_name=model_name, anthropic_api_key=config("ANTHROPIC_API_KEY"))
+
+
+def _openai(model_name):
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(model=model_name, openai_api_key=config("OPENAI_API_KEY"))
+
+
+MODEL_FACTORIES = {
+    "claude-3-haiku-20240307": _anthropic,
+    "gpt-3.5-turbo": _openai,
+    "gpt-4-turbo": _openai,
+    "gpt-4": _openai,
+    "gpt-4o": _openai,
+}
+
+
+# Every submind prompt opens with this exact text so providers can serve it from their prompt cache;
+# anything that varies per call belongs in the human message that follows
+CONTEXT_PREFIX = """You are the submind of a founder.
+
+Here's what you know about the founder: {founder}
+
+Here's what you know about the founder's values: {values}
+
+Here's your current state of mind: {mind}"""
+
+
+def context_prompt(context, template):
+    from langchain_core.messages import SystemMessage
+    from langchain_core.prompts import ChatPromptTemplate
+
+    # Filled in directly rather than templated so document contents can't change the prefix bytes
+    system = SystemMessage(content=CONTEXT_PREFIX.format(**context.as_prompt_inputs()))
+    return ChatPromptTemplate.from_messages([system, ("human", template)])
+
+
+def _prompt_cache_usage():
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class PromptCacheUsage(BaseCallbackHandler):
+        # Tallies prompt tokens served from the provider cache against those that weren't
+        def __init__(self):
+            self.cached_tokens = 0
+            self.uncached_tokens = 0
+            self.lock = threading.Lock()
+
+        def on_llm_end(self, response, **kwargs):
+            usages = [(response.llm_output or {}).get("token_usage") or (response.llm_output or {}).get("usage")]
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    usages.append(getattr(message, "response_metadata", {}).get("usage"))
+            for usage in usages:
+                if not usage:
+                    continue
+                if "prompt_tokens" in usage:
+                    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+                    uncached = usage["prompt_tokens"] - cached
+                elif "input_tokens" in usage:
+                    cached = usage.get("cache_read_input_tokens") or 0
+                    uncached = usage["input_tokens"] + (usage.get("cache_creation_input_tokens") or 0)
+                else:
+                    continue
+                with self.lock:
+                    self.cached_tokens += cached
+                    self.uncached_tokens += uncached
+                print(f"Prompt cache: {cached} cached, {uncached} uncached tokens "
+                      f"({self.cached_tokens} cached, {self.uncached_tokens} uncached so far)")
+                return
+
+    return PromptCacheUsage()
+
+
+def function_call_arguments(message, key):
+    # The named argument of a function-call reply, parsed outside the chain
+    return json.loads(message.additional_kwargs["function_call"]["arguments"])[key]
+
+
+class NoModelAvailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def _half_open(self):
+        return time.monotonic() - self.opened_at >= self.reset_seconds and not self.probing
+
+    def available(self):
+        with self.lock:
+            return self.opened_at is None or self._half_open()
+
+    def acquire(self):
+        # Once the reset window has passed exactly one caller is let through as a trial
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self._half_open():
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ModelRouter:
+    def __init__(self):
+        self.models = {}
+        self.breakers = {}
+        self.latencies = {}
+        self.cache_usage = None
+        self.lock = threading.Lock()
+
+    def model(self, name):
+        with self.lock:
+            if name not in self.models:
+                self.models[name] = MODEL_FACTORIES[name](name)
+                self.breakers[name] = CircuitBreaker()
+            return self.models[name]
+
+    def callbacks(self):
+        with self.lock:
+            if self.cache_usage is None:
+                self.cache_usage = _prompt_cache_usage()
+            return [self.cache_usage]
+
+    def breaker(self, name):
+        self.model(name)
+        return self.breakers[name]
+
+    def order(self, route):
+        available = [name for name in route if self.breaker(name).available()]
+        return sorted(available, key=lambda name: self.latency(name) > SLOW_MODEL_SECONDS)
+
+    def latency(self, name):
+        # Average latency, decayed for the time since it was last measured
+        with self.lock:
+            if name not in self.latencies:
+                return 0
+            seconds, measured_at = self.latencies[name]
+        return seconds * 0.5 ** ((time.monotonic() - measured_at) / LATENCY_HALF_LIFE_SECONDS)
+
+    def record_latency(self, name, seconds):
+        previous = self.latency(name) if name in self.latencies else None
+        with self.lock:
+            average = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+            self.latencies[name] = (average, time.monotonic())
+
+    def invoke(self, route, build_chain, inputs, parse=None):
+        # build_chain turns a chat model into the runnable to invoke, e.g. prompt | model | parser.
+        # Output that parse can't handle moves on to the next model without counting against the breaker,
+        # since the provider itself answered fine
+        for name in self.order(route):
+            breaker = self.breaker(name)
+            if not breaker.acquire():
+                continue
+            started = time.monotonic()
+            try:
+                result = build_chain(self.model(name)).invoke(inputs, config={"callbacks": self.callbacks()})
+            except Exception as e:
+                breaker.record_failure()
+                print(f"Failed to get response from {name}")
+                print(e)
+                continue
+            breaker.record_success()
+            self.record_latency(name, time.monotonic() - started)
+            if parse:
+                try:
+                    result = parse(result)
+                except Exception as e:
+                    print(f"Unusable response from {name}")
+                    print(e)
+                    continue
+            return result
+        raise NoModelAvailable(f"No model in {route} could respond")
+
+
+# Shared by every submind in the process so a tripped model is skipped everywhere
+router = ModelRouter()
@@ -1,6 +1,6 @@
 import enum
 
-from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, ForeignKey, Enum, Table
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, ForeignKey, Enum, Table, and_, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import UniqueConstraint, Index
@@ -399,6 +399,13 @@ class Answer(Base):
     researchId = Column(Integer, ForeignKey('Research.id'))
     research = relationship("Research")
 
+    # Partial index over requests that are still waiting on the podcast API; this table belongs to the app,
+    # so the runner only creates it when started with --install-schema
+    __table_args__ = (
+        Index('idx_answer_pending', 'submindId', 'id', postgresql_concurrently=True,
+              postgresql_where=and_(or_(content == '', content.is_(None)), requestId.isnot(None))),
+    )
+
 
 class Like(Base):
     __tablename__ = 'Like'
@@ -440,3 +447,24 @@ class Research(Base):
     answers = relationship("Answer", back_populates="research")
     response = Column(String)
     completed = Column(Boolean, default=False)
+
+
+# Not part of the web app's schema: owned by the runner and created on startup
+# so several runner nodes can share work without processing the same rows.
+class Lease(Base):
+    __tablename__ = 'SubmindLease'
+
+    resource = Column(String, primary_key=True)
+    owner = Column(String)
+    expiresAt = Column(DateTime)
+
+
+# Runner-owned as well: progress of an answer's snippet fold, so a restarted run can resume it
+class AnswerCheckpoint(Base):
+    __tablename__ = 'AnswerCheckpoint'
+
+    answerId = Column(Integer, ForeignKey('Answer.id', ondelete='CASCADE'), primary_key=True)
+    snippetsHash = Column(String)
+    step = Column(Integer)
+    content = Column(Text)
+    updatedAt = Column(DateTime)
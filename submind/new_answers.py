@@ -1,35 +1,167 @@
-import re
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import requests
 from decouple import config
-from langchain_anthropic import ChatAnthropic
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from sqlalchemy import and_, or_
 
-from submind.models import Answer
+from submind.llm import ANSWER_ROUTE, NoModelAvailable, router
+from submind.models import Answer, AnswerCheckpoint
+from submind.podcast_api import query_statuses
+from submind.snippets import preprocess_snippets
 
+PENDING_ANSWER = and_(or_(Answer.content == '', Answer.content.is_(None)), Answer.requestId.isnot(None))
 
-def pull_new_answers(session, submind):
+# "fold" revises one answer snippet by snippet; "tree" answers every snippet in parallel and merges pairwise
+ANSWER_STRATEGY = config('ANSWER_STRATEGY', default='fold')
+ANSWER_CONCURRENCY = config('ANSWER_CONCURRENCY', default=8, cast=int)
+
+ANSWER_TEMPLATE = """You are a recursive answer compiler. Given a question, your answer so far, and a new snippet,
+ your job is to revise your answer with the information in the new snippet. 
+
+
+
+"""
+
+HUMAN_MESSAGE_TEMPLATE = """ Here is the question: {question}
+
+Here is your answer so far: {answer}
+
+Here is the next snippet: {snippet}"""
+
+MERGE_TEMPLATE = """You are a recursive answer compiler. Given a question and two partial answers compiled from
+ different snippets, your job is to merge them into a single answer that keeps the information from both.
+"""
+
+MERGE_HUMAN_MESSAGE_TEMPLATE = """ Here is the question: {question}
+
+Here is the first partial answer: {first}
+
+Here is the second partial answer: {second}"""
+
+
+def _prompt(system_template, human_template):
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages([("system", system_template), ("human", human_template)])
+
+
+def _invoke(prompt, inputs, default):
+    from langchain_core.output_parsers import StrOutputParser
+
+    try:
+        return router.invoke(ANSWER_ROUTE, lambda model: prompt | model | StrOutputParser(), inputs)
+    except NoModelAvailable as e:
+        print("Failed to get answer")
+        print(e)
+        return default
+
+
+class FoldCheckpoint:
+    def __init__(self, session, answer_id, snippets):
+        self.session = session
+        self.answer_id = answer_id
+        self.snippets_hash = hashlib.sha256("\0".join(snippets).encode()).hexdigest()
+
+    def load(self):
+        # A checkpoint only applies if the snippets are the same ones it was folding
+        checkpoint = self.session.get(AnswerCheckpoint, self.answer_id)
+        if checkpoint and checkpoint.snippetsHash == self.snippets_hash:
+            print(f"Resuming answer {self.answer_id} from snippet {checkpoint.step}")
+            return checkpoint.step, checkpoint.content
+        return 0, ""
+
+    def save(self, step, content):
+        checkpoint = self.session.get(AnswerCheckpoint, self.answer_id) or AnswerCheckpoint(answerId=self.answer_id)
+        checkpoint.snippetsHash = self.snippets_hash
+        checkpoint.step = step
+        checkpoint.content = content
+        checkpoint.updatedAt = datetime.now()
+        self.session.add(checkpoint)
+        self.session.commit()
+
+    def clear(self):
+        self.session.query(AnswerCheckpoint).filter(AnswerCheckpoint.answerId == self.answer_id).delete(
+            synchronize_session=False)
+
+
+def fold_answer(question, snippets, checkpoint=None):
+    prompt = _prompt(ANSWER_TEMPLATE, HUMAN_MESSAGE_TEMPLATE)
+    start, current_answer = checkpoint.load() if checkpoint else (0, "")
+    for index in range(start, len(snippets)):
+        current_answer = _invoke(prompt, {"question": question, "answer": current_answer, "snippet": snippets[index]},
+                                 current_answer)
+        if checkpoint:
+            checkpoint.save(index + 1, current_answer)
+    return current_answer
+
+
+def tree_answer(question, snippets, checkpoint=None):
+    # Partial answers are merged in memory, so the tree strategy always starts over
+    answer_prompt = _prompt(ANSWER_TEMPLATE, HUMAN_MESSAGE_TEMPLATE)
+    merge_prompt = _prompt(MERGE_TEMPLATE, MERGE_HUMAN_MESSAGE_TEMPLATE)
+
+    def answer(snippet):
+        return _invoke(answer_prompt, {"question": question, "answer": "", "snippet": snippet}, "")
+
+    def merge(pair):
+        if len(pair) == 1:
+            return pair[0]
+        first, second = pair
+        return _invoke(merge_prompt, {"question": question, "first": first, "second": second},
+                       f"{first}\n{second}")
+
+    with ThreadPoolExecutor(max_workers=ANSWER_CONCURRENCY) as pool:
+        partial_answers = [partial for partial in pool.map(answer, snippets) if partial]
+        while len(partial_answers) > 1:
+            pairs = [partial_answers[i:i + 2] for i in range(0, len(partial_answers), 2)]
+            partial_answers = list(pool.map(merge, pairs))
+    return partial_answers[0] if partial_answers else ""
+
+
+ANSWER_STRATEGIES = {
+    "fold": fold_answer,
+    "tree": tree_answer,
+}
+
+
+def ensure_answer_schema(engine):
+    AnswerCheckpoint.__table__.create(engine, checkfirst=True)
+
+
+def install_answer_indexes(engine):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for index in Answer.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def pending_answers_by_submind(session):
+    rows = session.query(Answer.submindId, Answer.id).filter(PENDING_ANSWER).order_by(
+        Answer.submindId, Answer.id).all()
+    pending = {}
+    for submind_id, answer_id in rows:
+        pending.setdefault(submind_id, []).append(answer_id)
+    return pending
+
+
+def pull_new_answers(session, submind, answer_ids=None):
     new_answers = []
 
-    unanswered_questions = session.query(Answer).filter(
-        and_(or_(Answer.content == '', Answer.content.is_(None)), Answer.submindId == submind.id)).all()
+    unanswered_questions = session.query(Answer).filter(PENDING_ANSWER, Answer.submindId == submind.id)
+    if answer_ids is not None:
+        unanswered_questions = unanswered_questions.filter(Answer.id.in_(answer_ids))
+    unanswered_questions = unanswered_questions.all()
     print(f'Unanswered questions for submind {submind.id}: {len(unanswered_questions)}')
     errored_answers = []
+    # Poll every outstanding query at once rather than one request per question
+    statuses = query_statuses([question.requestId for question in unanswered_questions])
     for question in unanswered_questions:
-        url = f'{config("API_URL")}podcast/query/'
-        query = {'query_id': question.requestId}
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Api-Key {config("API_KEY")}'
-        }
-
-        # Make the POST request
-        response = requests.post(url, json=query, headers=headers)
-
-        data = response.json()
+        data = statuses[question.requestId]
+        if data is None:
+            print("Could not poll query. Skipping")
+            continue
         if data['status'] != 'Completed':
             print("Query still running. Skipping")
             continue
@@ -37,73 +169,15 @@ def pull_new_answers(session, submind):
             errored_answers.append(question)
             continue
         # print(f"Found {len(data['results'])} snippets")
-
-        ANSWER_TEMPLATE = """You are a recursive answer compiler. Given a question, your answer so far, and a new snippet,
-         your job is to revise your answer with the information in the new snippet. 
-
-
-
-        """
-
-        HUMAN_MESSAGE_TEMPLATE = """ Here is the question: {question}
-        
-        Here is your answer so far: {answer}
-
-        Here is the next snippet: {snippet}"""
-        model_35 = ChatOpenAI(model="gpt-3.5-turbo", openai_api_key=config("OPENAI_API_KEY"))
-        model_4 = ChatOpenAI(model="gpt-4-turbo", openai_api_key=config("OPENAI_API_KEY"))
-        model_claude = ChatAnthropic(model_name="claude-3-haiku-20240307",
-                                     anthropic_api_key=config("ANTHROPIC_API_KEY"))
-        prompt = ChatPromptTemplate.from_messages([("system", ANSWER_TEMPLATE), ("human", HUMAN_MESSAGE_TEMPLATE)])
-        output_parser = StrOutputParser()
-        current_answer = ""
-        for snippet in data['results']:
-
-            try:
-                chain = prompt | model_claude | output_parser
-                # remove all timestamps in [] brackets
-                cleaned_text = re.sub(r'\[\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3}\]', '',
-                                      snippet['snippet'])
-                current_answer = chain.invoke(
-                    {"question": question.question.content,
-                     "answer": current_answer,
-                     "snippet": cleaned_text
-                     })
-            except Exception as e:
-                try:
-                    print("Failed to get answer from claude-3-haiku-20240307, using gpt-3.5-turbo")
-                    print(e)
-                    chain = prompt | model_35 | output_parser
-                    # remove all timestamps in [] brackets
-                    cleaned_text = re.sub(r'\[\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3}\]', '',
-                                          snippet['snippet'])
-
-                    current_answer = chain.invoke(
-                        {"question": question.question.content,
-                         "answer": current_answer,
-                         "snippet": cleaned_text
-                         })
-                except Exception as e2:
-                    try:
-                        print("Failed to get answer from gpt-3.5-turbo, using gpt-4-turbo")
-                        print(e2)
-                        chain = prompt | model_4 | output_parser
-                        # remove all timestamps in [] brackets
-                        cleaned_text = re.sub(r'\[\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3}\]', '',
-                                              snippet['snippet'])
-
-                        current_answer = chain.invoke(
-                            {"question": question.question.content,
-                             "answer": current_answer,
-                             "snippet": cleaned_text
-                             })
-
-                    except Exception as e3:
-                        print("Failed to get answer")
-                        print(e3)
-                        continue
+        snippets = preprocess_snippets([snippet['snippet'] for snippet in data['results']])
+        checkpoint = FoldCheckpoint(session, question.id, snippets)
+        started = time.monotonic()
+        current_answer = ANSWER_STRATEGIES[ANSWER_STRATEGY](question.question.content, snippets, checkpoint)
+        print(f'Compiled answer {question.id} from {len(data["results"])} snippets in {len(snippets)} chunks '
+              f'with {ANSWER_STRATEGY} in {time.monotonic() - started:.1f}s')
         question.content = current_answer
         session.add(question)
+        checkpoint.clear()
         session.commit()
         new_answers.append(f'{question.question.content}\n{current_answer}')
     print(f'New answers for submind {submind.id}: {len(new_answers)}')
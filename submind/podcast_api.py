@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+PODCAST_API_CONCURRENCY = config('PODCAST_API_CONCURRENCY', default=16, cast=int)
+PODCAST_API_TIMEOUT = config('PODCAST_API_TIMEOUT', default=30, cast=float)
+PODCAST_API_RETRIES = config('PODCAST_API_RETRIES', default=3, cast=int)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive connection pool shared by every caller in the process
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=PODCAST_API_RETRIES, backoff_factor=0.5,
+                          status_forcelist=(429, 500, 502, 503, 504), allowed_methods=None)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PODCAST_API_CONCURRENCY, max_retries=retry)
+            # find starts a search on the server, so it is only retried when the request can't have reached it
+            find_retry = Retry(total=PODCAST_API_RETRIES, connect=PODCAST_API_RETRIES, read=0, other=0,
+                               backoff_factor=0.5, status_forcelist=(429,), allowed_methods=None)
+            find_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PODCAST_API_CONCURRENCY, max_retries=find_retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.mount(f'{config("API_URL")}podcast/find/', find_adapter)
+            _session.headers.update({
+                'Content-Type': 'application/json',
+                'Authorization': f'Api-Key {config("API_KEY")}'
+            })
+        return _session
+
+
+def _post(path, payload):
+    response = get_session().post(f'{config("API_URL")}{path}', json=payload, timeout=PODCAST_API_TIMEOUT)
+    # error bodies are JSON too; don't let them pass for a search or a status
+    response.raise_for_status()
+    return response.json()
+
+
+def find(query):
+    return _post('podcast/find/', {'query': query})
+
+
+def query_status(query_id):
+    return _post('podcast/query/', {'query_id': query_id})
+
+
+def _gather(call, items):
+    # Failed calls come back as None so one bad request doesn't sink the batch
+    def safe_call(item):
+        try:
+            return call(item)
+        except Exception as e:
+            print(f"Podcast API request failed for {item}")
+            print(e)
+            return None
+
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(PODCAST_API_CONCURRENCY, len(items))) as pool:
+        return list(pool.map(safe_call, items))
+
+
+def find_many(queries):
+    return _gather(find, queries)
+
+
+def query_statuses(query_ids):
+    return dict(zip(query_ids, _gather(query_status, query_ids)))
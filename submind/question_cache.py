@@ -0,0 +1,56 @@
+import re
+from datetime import datetime, timedelta
+
+from decouple import config
+from sqlalchemy import or_
+
+from submind.models import Answer, Question
+
+QUESTION_CACHE_THRESHOLD = config('QUESTION_CACHE_THRESHOLD', default=0.85, cast=float)
+QUESTION_CACHE_TTL_DAYS = config('QUESTION_CACHE_TTL_DAYS', default=30, cast=int)
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def normalize_question(text):
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+
+def _similarity(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def find_cached_answers(session, owner_id, questions):
+    # Only the question text and answer id of the owner's recent answers are fetched, once for the whole
+    # batch; the answers themselves are loaded just for the matches
+    if QUESTION_CACHE_THRESHOLD > 1:
+        return [None] * len(questions)
+    since = datetime.now() - timedelta(days=QUESTION_CACHE_TTL_DAYS)
+    rows = session.query(Question.content, Answer.id).join(Answer, Answer.questionId == Question.id).filter(
+        Question.ownerId == owner_id,
+        or_(Question.error.is_(None), Question.error == ''),
+        Answer.content.isnot(None), Answer.content != '',
+        Answer.createdAt >= since).order_by(Answer.createdAt.desc()).all()
+    # newest answer per distinct question
+    latest = {}
+    for content, answer_id in rows:
+        if content:
+            latest.setdefault(normalize_question(content), answer_id)
+    candidates = [(candidate, set(candidate.split()), answer_id) for candidate, answer_id in latest.items()]
+
+    cached = []
+    for question in questions:
+        normalized = normalize_question(question)
+        if normalized in latest:
+            cached.append(latest[normalized])
+            continue
+        words = set(normalized.split())
+        best, best_score = None, 0.0
+        for candidate, candidate_words, answer_id in candidates:
+            score = _similarity(candidate_words, words)
+            if score >= QUESTION_CACHE_THRESHOLD and score > best_score:
+                best, best_score = answer_id, score
+        cached.append(best)
+    return [session.get(Answer, answer_id) if answer_id else None for answer_id in cached]
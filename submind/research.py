@@ -1,24 +1,19 @@
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import requests
 from decouple import config
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.output_parsers.openai_functions import JsonKeyOutputFunctionsParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from sqlalchemy import exists, or_
 
-from submind.documents import get_document
-from submind.models import Thought, Research, Question, Answer
+from submind.documents import document_cache, load_submind_context, load_submind_contexts
+from submind.llm import CONTEXT_ROUTE, GPT_4_ROUTE, context_prompt, function_call_arguments, router
+from submind.models import Thought, Research, Question, Answer, question_research_table
 from submind.new_answers import pull_new_answers
+from submind.podcast_api import find_many
+from submind.question_cache import find_cached_answers
+from submind.snippets import pack_snippets
 
-RESEARCH_PROMPT = """You are a submind of a founder that is dedicated to doing research for them.
-
-    Here's what you know about the founder: {founder}
-    
-    Here's what you know about the founder's values: {values}
-    
-    Here's what you know so far: {mind}
+RESEARCH_PROMPT = """You are dedicated to doing research for the founder.
     
     Here's the thought you just received: {thought}
     
@@ -33,12 +28,7 @@ RESEARCH_PROMPT = """You are a submind of a founder that is dedicated to doing r
 
 """
 
-COMPLETE_RESEARCH_PROMPT = """You are a submind of a founder that is dedicated to doing research for them.
-  Here's what you know about the founder: {founder}
-    
-    Here's what you know about the founder's values: {values}
-    
-    Here's what you know so far: {mind}
+COMPLETE_RESEARCH_PROMPT = """You are dedicated to doing research for the founder.
     
     Here are the questions you've asked and the answers you've received so far: {research}
     
@@ -47,6 +37,18 @@ COMPLETE_RESEARCH_PROMPT = """You are a submind of a founder that is dedicated t
     
 """
 
+SUMMARIZE_RESEARCH_PROMPT = """You are a submind of a founder that is dedicated to doing research for them.
+
+    Here are some of the questions you've asked and the answers you've received: {research}
+    
+    Summarize these questions and answers, keeping every finding that could be useful to the founder.
+    
+    
+"""
+
+REPORT_CHUNK_TOKENS = config('REPORT_CHUNK_TOKENS', default=4000, cast=int)
+REPORT_CONCURRENCY = config('REPORT_CONCURRENCY', default=4, cast=int)
+
 functions = [
     {
         "name": "research_questions",
@@ -93,25 +95,26 @@ functions = [
 ]
 
 
-def start_research(submind, thought, message, session):
-    model = ChatOpenAI(model="gpt-4", openai_api_key=config("OPENAI_API_KEY"))
-    prompt = ChatPromptTemplate.from_template(RESEARCH_PROMPT)
-    chain = prompt | model.bind(function_call={"name": "research_questions"},
-                                functions=functions) | JsonKeyOutputFunctionsParser(key_name="research")
+def plan_research(context, thought_content, message):
+    # Model call only, so plans for several thoughts can be made in parallel and recorded in order
+    def build_chain(model):
+        return context_prompt(context, RESEARCH_PROMPT) | model.bind(
+            function_call={"name": "research_questions"}, functions=functions)
 
-    mind = get_document(submind.mindUUID, submind.ownerId)
-    values = get_document(submind.valuesUUID, submind.ownerId)
-    founder = get_document(submind.founderUUID, submind.ownerId)
+    return router.invoke(CONTEXT_ROUTE, build_chain,
+        {"thought": thought_content,
+         "research_topic": message},
+        parse=lambda response: function_call_arguments(response, "research"))
 
 
+def start_research(submind, thought, message, session):
+    context = load_submind_context(submind)
+    record_research(submind, thought, plan_research(context, thought.content, message), session)
+    session.commit()
 
 
-    response = chain.invoke(
-        {"founder": founder['content'],
-         "values": values['content'],
-         "mind": mind['content'],
-         "thought": thought.content,
-         "research_topic": message})
+def record_research(submind, thought, response, session):
+    # Stages every row for the research, answer requests included, and leaves the commit to the caller
     new_thought = Thought()
     new_thought.content = response['summary']
     new_thought.submindId = submind.id
@@ -121,7 +124,6 @@ def start_research(submind, thought, message, session):
     new_thought.parentId = thought.id
     new_thought.ownerId = submind.ownerId
     session.add(new_thought)
-    session.commit()
 
     research = Research()
     research.submindId = submind.id
@@ -129,9 +131,8 @@ def start_research(submind, thought, message, session):
     research.description = response['summary']
     research.createdAt = datetime.now()
     research.updatedAt = datetime.now()
-    research.respondToId = new_thought.id
+    research.respondTo = new_thought
     session.add(research)
-    session.commit()
 
     answerable_questions = []
 
@@ -144,71 +145,106 @@ def start_research(submind, thought, message, session):
         research_question.updatedAt = datetime.now()
         research_question.contextId = submind.contextId
         research_question.ownerId = submind.ownerId
-        session.add(research_question)
-        session.commit()
         answerable_questions.append(research_question)
-        research.questions.append(research_question)
-        session.add(research)
-        session.commit()
-
-    for answerable in answerable_questions:
-        url = f'{config("API_URL")}podcast/find/'
-        query = {'query': answerable.content}  # Replace 'your query here' with your actual query
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Api-Key {config("API_KEY")}'
-        }
-
-        # Make the POST request
-        response = requests.post(url, json=query, headers=headers)
-
-        # Parse the JSON response
-        data = response.json()
-
+    research.questions.extend(answerable_questions)
+
+    # Near-duplicates of questions the owner already has answers for skip the search entirely
+    with session.no_autoflush:
+        cached_answers = find_cached_answers(session, submind.ownerId,
+                                             [answerable.content for answerable in answerable_questions])
+    answer_requests = []
+    to_search = []
+    for answerable, cached in zip(answerable_questions, cached_answers):
+        if cached is None:
+            to_search.append(answerable)
+            continue
+        print(f"Reusing answer {cached.id} for question {answerable.content!r}")
+        reused_answer = Answer()
+        reused_answer.question = answerable
+        reused_answer.content = cached.content
+        reused_answer.requestId = cached.requestId
+        reused_answer.createdAt = datetime.now()
+        reused_answer.updatedAt = datetime.now()
+        reused_answer.source = cached.source
+        reused_answer.submindId = submind.id
+        answer_requests.append(reused_answer)
+
+    found = find_many([answerable.content for answerable in to_search])
+
+    for answerable, data in zip(to_search, found):
+        if data is None:
+            answerable.error = "Error starting search"
+            continue
         saved_answer_request = Answer()
-        saved_answer_request.questionId = answerable.id
+        saved_answer_request.question = answerable
         saved_answer_request.requestId = data['query_id']
         saved_answer_request.createdAt = datetime.now()
         saved_answer_request.updatedAt = datetime.now()
         saved_answer_request.source = "internet"
         saved_answer_request.submindId = submind.id
-        session.add(saved_answer_request)
-        session.commit()
+        answer_requests.append(saved_answer_request)
+    session.add_all(answer_requests)
 
 
+@document_cache()
 def update_research(session):
-    research = session.query(Research).filter(Research.completed == False).all()
+    # Research is ready once none of its non-errored questions is still missing an answer,
+    # decided in a single query instead of walking every open research's questions and answers
+    answered = exists().where(Answer.questionId == Question.id, Answer.content.isnot(None), Answer.content != '')
+    open_question = exists().where(question_research_table.c.B == Research.id,
+                                   question_research_table.c.A == Question.id,
+                                   or_(Question.error.is_(None), Question.error == ''),
+                                   ~answered)
+    research = session.query(Research).filter(Research.completed == False, ~open_question).all()
+    # one round trip for the context documents of every submind that is about to report
+    load_submind_contexts({item.submind for item in research})
     for item in research:
-        all_answered = all(any(answer.content for answer in question.answers if answer.content) for question in item.questions if not question.error)
-        if all_answered:
-            complete_research(session, item)
+        complete_research(session, item)
 
 
 
+def summarize_research(question_answers):
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+
+    prompt = ChatPromptTemplate.from_template(SUMMARIZE_RESEARCH_PROMPT)
+    output_parser = StrOutputParser()
+
+    def summarize(chunk):
+        return router.invoke(GPT_4_ROUTE, lambda model: prompt | model | output_parser, {"research": chunk})
+
+    # Summarize token-bounded groups of Q&A in parallel until everything fits in one prompt
+    chunks = pack_snippets(question_answers, REPORT_CHUNK_TOKENS)
+    while len(chunks) > 1:
+        print(f"Summarizing research in {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=REPORT_CONCURRENCY) as pool:
+            summaries = list(pool.map(summarize, chunks))
+        merged = pack_snippets(summaries, REPORT_CHUNK_TOKENS)
+        if len(merged) >= len(chunks):
+            # summaries stopped shrinking; hand them all to the final report as they are
+            return "\n\n".join(summaries)
+        chunks = merged
+    return chunks[0] if chunks else ""
+
+
 def complete_research(session, research):
+    from langchain_core.output_parsers import StrOutputParser
+
     submind = research.submind
-    model = ChatOpenAI(model="gpt-4", openai_api_key=config("OPENAI_API_KEY"))
-    prompt = ChatPromptTemplate.from_template(COMPLETE_RESEARCH_PROMPT)
     output_parser = StrOutputParser()
-    chain = prompt | model | output_parser
 
-    mind = get_document(submind.mindUUID, submind.ownerId)
-    values = get_document(submind.valuesUUID, submind.ownerId)
-    founder = get_document(submind.founderUUID, submind.ownerId)
+    context = load_submind_context(submind)
 
-    combined = ""
+    question_answers = []
     for question in research.questions:
-        combined += f"{question.content}:\n"
-        for answer in question.answers:
-            combined += f"{answer.content}\n"
+        question_answers.append(f"{question.content}:\n" + "".join(f"{answer.content}\n" for answer in question.answers))
+    combined = summarize_research(question_answers)
 
     # research_content = map(lambda question: f"{question.content}:" + "\n".join(map(lambda answer: answer.content, question.answers)), research.questions)
 
-    response = chain.invoke(
-        {"founder": founder['content'],
-         "values": values['content'],
-         "mind": mind['content'],
-         "research": combined})
+    response = router.invoke(CONTEXT_ROUTE,
+        lambda model: context_prompt(context, COMPLETE_RESEARCH_PROMPT) | model | output_parser,
+        {"research": combined})
     print(response)
     research.response = response
     research.completed = True
@@ -0,0 +1,57 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from submind.leases import LEASES_ENABLED, claim_submind, lease_heartbeat, release, submind_resource
+from submind.models import Submind
+
+
+def run_subminds(Session, submind_ids, stage, workers=1):
+    # Each worker thread gets its own session; a failing submind is rolled back
+    # and reported without affecting the others.
+    local = threading.local()
+    sessions = []
+    sessions_lock = threading.Lock()
+
+    def worker_session():
+        if not hasattr(local, "session"):
+            local.session = Session()
+            with sessions_lock:
+                sessions.append(local.session)
+        return local.session
+
+    def run_one(submind_id):
+        session = worker_session()
+        if LEASES_ENABLED and not claim_submind(session, submind_id):
+            print(f"Submind {submind_id} is leased by another node. Skipping")
+            return True
+        try:
+            with lease_heartbeat(session.get_bind()) if LEASES_ENABLED else nullcontext():
+                submind = session.get(Submind, submind_id)
+                if submind:
+                    stage(session, submind)
+            return True
+        except Exception:
+            session.rollback()
+            print(f"Submind {submind_id} failed")
+            traceback.print_exc()
+            return False
+        finally:
+            if LEASES_ENABLED:
+                release(session, submind_resource(submind_id))
+
+    try:
+        if workers <= 1:
+            results = [run_one(submind_id) for submind_id in submind_ids]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(run_one, submind_ids))
+    finally:
+        for session in sessions:
+            session.close()
+
+    failed = [submind_id for submind_id, ok in zip(submind_ids, results) if not ok]
+    if failed:
+        print(f"Failed subminds: {failed}")
+    return failed
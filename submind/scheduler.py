@@ -0,0 +1,107 @@
+import heapq
+import time
+from datetime import datetime, timedelta
+
+from decouple import config
+
+from submind.models import Submind, SubmindSchedule, User
+from submind.runner import run_subminds
+
+SCHEDULE_INTERVALS = {
+    SubmindSchedule.DAILY: timedelta(days=1),
+    SubmindSchedule.EIGHT_HOUR: timedelta(hours=8),
+    SubmindSchedule.FOUR_HOUR: timedelta(hours=4),
+    SubmindSchedule.INSTANT: timedelta(seconds=config('INSTANT_INTERVAL_SECONDS', default=300, cast=int)),
+}
+
+
+class SubmindScheduler:
+    def __init__(self, Session, stage, workers=1, poll=None, listener=None,
+                 refresh_interval=timedelta(seconds=config('SCHEDULER_REFRESH_SECONDS', default=300, cast=int))):
+        self.Session = Session
+        self.stage = stage
+        self.workers = workers
+        self.poll = poll
+        self.listener = listener
+        self.refresh_interval = refresh_interval
+        self.next_refresh = datetime.now()
+        # heap of (due, submind_id); entries holds the current due time so stale heap items can be skipped
+        self.queue = []
+        self.entries = {}
+        self.intervals = {}
+        # failed subminds aren't retried before this, since their lastRun doesn't move
+        self.retry_at = {}
+
+    def schedule(self, submind_id, due):
+        if self.entries.get(submind_id) == due:
+            return
+        self.entries[submind_id] = due
+        heapq.heappush(self.queue, (due, submind_id))
+
+    def refresh(self):
+        if self.poll:
+            self.poll()
+        now = datetime.now()
+        session = self.Session()
+        try:
+            rows = session.query(Submind.id, Submind.schedule, Submind.lastRun, User.instantAccessUntil).outerjoin(
+                User, Submind.ownerId == User.id).filter(Submind.schedule.isnot(None)).all()
+        finally:
+            session.close()
+
+        self.intervals = {}
+        for submind_id, schedule, last_run, instant_access_until in rows:
+            interval = SCHEDULE_INTERVALS[schedule]
+            if instant_access_until and instant_access_until > now:
+                interval = SCHEDULE_INTERVALS[SubmindSchedule.INSTANT]
+            self.intervals[submind_id] = interval
+            due = last_run + interval if last_run else now
+            if submind_id in self.retry_at:
+                due = max(due, self.retry_at[submind_id])
+            self.schedule(submind_id, due)
+
+        for submind_id in set(self.entries) - set(self.intervals):
+            del self.entries[submind_id]
+            self.retry_at.pop(submind_id, None)
+        self.next_refresh = now + self.refresh_interval
+
+    def pop_due(self, now):
+        due_ids = []
+        while self.queue and self.queue[0][0] <= now:
+            due, submind_id = heapq.heappop(self.queue)
+            if self.entries.get(submind_id) == due:
+                due_ids.append(submind_id)
+        return due_ids
+
+    def next_wakeup(self):
+        while self.queue and self.entries.get(self.queue[0][1]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+        if self.queue:
+            return min(self.queue[0][0], self.next_refresh)
+        return self.next_refresh
+
+    def dispatch(self, submind_ids):
+        if not submind_ids:
+            return
+        print(f"Dispatching subminds: {submind_ids}")
+        failed = set(run_subminds(self.Session, submind_ids, self.stage, self.workers))
+        # failed subminds are rescheduled as well, so a broken submind can't spin the loop
+        now = datetime.now()
+        for submind_id in submind_ids:
+            if submind_id in failed:
+                self.retry_at[submind_id] = now + self.intervals.get(submind_id, self.refresh_interval)
+            else:
+                self.retry_at.pop(submind_id, None)
+            if submind_id in self.intervals:
+                self.schedule(submind_id, now + self.intervals[submind_id])
+
+    def run_forever(self):
+        while True:
+            if datetime.now() >= self.next_refresh:
+                self.refresh()
+            self.dispatch(self.pop_due(datetime.now()))
+            timeout = max(0.0, (self.next_wakeup() - datetime.now()).total_seconds())
+            if self.listener:
+                self.dispatch(self.listener.wait(timeout))
+            else:
+                time.sleep(timeout)
@@ -0,0 +1,71 @@
+import re
+
+from decouple import config
+
+TIMESTAMP_PATTERN = re.compile(r'\[\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3}\]')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+WORD_PATTERN = re.compile(r'\w+')
+
+# Share of a snippet's word 3-grams that must appear in another snippet for it to count as a duplicate
+SNIPPET_SIMILARITY_THRESHOLD = config('SNIPPET_SIMILARITY_THRESHOLD', default=0.8, cast=float)
+SNIPPET_TOKEN_BUDGET = config('SNIPPET_TOKEN_BUDGET', default=3000, cast=int)
+CHARS_PER_TOKEN = 4
+SHINGLE_SIZE = 3
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def clean_snippet(text):
+    # remove all timestamps in [] brackets
+    return WHITESPACE_PATTERN.sub(' ', TIMESTAMP_PATTERN.sub('', text)).strip()
+
+
+def _shingles(text):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _containment(first, second):
+    return len(first & second) / min(len(first), len(second))
+
+
+def dedupe_snippets(snippets, threshold=SNIPPET_SIMILARITY_THRESHOLD):
+    kept = []
+    for snippet in snippets:
+        if not snippet:
+            continue
+        shingles = _shingles(snippet)
+        for i, (other, other_shingles) in enumerate(kept):
+            if _containment(shingles, other_shingles) >= threshold:
+                # overlapping transcript windows: keep whichever covers more
+                if len(shingles) > len(other_shingles):
+                    kept[i] = (snippet, shingles)
+                break
+        else:
+            kept.append((snippet, shingles))
+    return [snippet for snippet, _ in kept]
+
+
+def pack_snippets(snippets, token_budget=SNIPPET_TOKEN_BUDGET):
+    chunks = []
+    current = []
+    current_tokens = 0
+    for snippet in snippets:
+        tokens = estimate_tokens(snippet)
+        if current and current_tokens + tokens > token_budget:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(snippet)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def preprocess_snippets(snippets):
+    return pack_snippets(dedupe_snippets([clean_snippet(snippet) for snippet in snippets]))
@@ -2,16 +2,12 @@ import time
 import uuid
 from datetime import datetime
 
-import requests
 from decouple import config
-from langchain.embeddings import OpenAIEmbeddings
 from langchain_anthropic import ChatAnthropic
 from langchain_community.output_parsers.ernie_functions import JsonKeyOutputFunctionsParser
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone
 from sqlalchemy import and_, or_
 
 from submind.documents import get_document, update_document, create_document, create_report
@@ -19,6 +15,9 @@ from submind.final_run import final_run
 from submind.initial_run import initial_run
 from submind.models import Thought, Question, Answer
 from submind.new_answers import pull_new_answers
+from submind.podcast_api import find
+from submind.question_cache import find_cached_answers
+from submind.vectors import get_vectorstore
 
 functions = [
     {
@@ -83,11 +82,7 @@ def find_related_thoughts(submind, session):
     # human_answers = session.query(Answer).filter(Answer.submindId == submind.id, Answer.source == "user").all()
     # combined_answers = new_answers + list(map(lambda x: f'{x.question.content}: {x.content}', human_answers))
 
-    pc = Pinecone(api_key=config("PINECONE_API_KEY"))
-    embeddings = OpenAIEmbeddings(openai_api_key=config("OPENAI_API_KEY"))
-
-    index = pc.Index(config("PINECONE_INDEX_NAME"), host=config("PINECONE_HOST"))
-    vectorstore = PineconeVectorStore(index, embeddings, "text", namespace=config('PINECONE_NAMESPACE'))
+    vectorstore = get_vectorstore()
 
 
     PROMPT_TEMPLATE = """You are a powerful submind that allows your human to externalize their thought process.
@@ -237,23 +232,17 @@ def find_related_thoughts(submind, session):
         if new_question.forInternet:
             answerable_questions.append(new_question)
 
-    for answerable in answerable_questions:
-        url = f'{config("API_URL")}podcast/find/'
-        query = {'query': answerable.content}  # Replace 'your query here' with your actual query
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Api-Key {config("API_KEY")}'
-        }
-
-        # Make the POST request
-        response = requests.post(url, json=query, headers=headers)
-
-        # Parse the JSON response
-        data = response.json()
-
+    cached_answers = find_cached_answers(session, submind.ownerId,
+                                         [answerable.content for answerable in answerable_questions])
+    for answerable, cached in zip(answerable_questions, cached_answers):
         saved_answer_request = Answer()
         saved_answer_request.questionId = answerable.id
-        saved_answer_request.requestId = data['query_id']
+        if cached is not None:
+            saved_answer_request.content = cached.content
+            saved_answer_request.requestId = cached.requestId
+        else:
+            data = find(answerable.content)
+            saved_answer_request.requestId = data['query_id']
         saved_answer_request.createdAt = datetime.now()
         saved_answer_request.updatedAt = datetime.now()
         saved_answer_request.source = "internet"
@@ -1,15 +1,25 @@
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from decouple import config
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.output_parsers.openai_functions import JsonKeyOutputFunctionsParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 
-from submind.documents import get_or_create_document
+from submind.documents import document_cache, load_submind_context
+from submind.leases import LEASES_ENABLED, claim_pending_thoughts, release, thought_resource
+from submind.llm import CONTEXT_ROUTE, NoModelAvailable, context_prompt, function_call_arguments, router
 from submind.models import Like, Thought, Task
-from submind.research import start_research
+from submind.research import plan_research, record_research
+from submind.snippets import estimate_tokens
+
+# Token budget for the thoughts sent in one batched classification call; 0 classifies each thought separately
+THOUGHT_BATCH_TOKENS = config('THOUGHT_BATCH_TOKENS', default=2000, cast=int)
+THOUGHT_BATCH_MAX = config('THOUGHT_BATCH_MAX', default=20, cast=int)
+# Pending thoughts whose writes are committed together; 1 commits after every thought
+THOUGHT_COMMIT_EVERY = max(1, config('THOUGHT_COMMIT_EVERY', default=10, cast=int))
+# Thoughts of one submind classified and planned at the same time
+THOUGHT_CONCURRENCY = config('THOUGHT_CONCURRENCY', default=4, cast=int)
+RESPONSE_TYPES = ["research", "question", "action"]
 
 functions = [
     {
@@ -55,17 +65,45 @@ functions = [
     }
 ]
 
+batch_functions = [
+    {
+        "name": "respond_to_thoughts",
+        "description": "respond to each of several thoughts from the founder",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "responses": {
+                    "type": "array",
+                    "description": "One response per thought",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "thoughtId": {
+                                "type": "integer",
+                                "description": "The id of the thought you are responding to"
+                            },
+                            "responseType": {
+                                "type": "string",
+                                "description": "The type of response you want to give",
+                                "enum": RESPONSE_TYPES
+                            },
+                            "message": {
+                                "type": "string",
+                                "description": "The message you want to send"
+                            }
+                        },
+                        "required": ["thoughtId", "responseType", "message"]
+                    }
+                },
+            },
+            "required": ["responses"],
+        },
+    }
+]
+
 SUBMIND_INITIAL_PROMPT = """
-    You are the submind of a founder. 
-    
     Your job is to align your values with them as much as possible and help them out in any way you can.
     
-    Here's what you know about the founder: {founder}
-    
-    From interacting with the founder, you have learned these values so far: {values}
-    
-    Here's your current state of mind: {mind}
-    
     You have just received a thought from the founder: {thought}
     
     Based on this thought, your shared values, and your current state of mind, what do you think your next action should be?
@@ -75,38 +113,140 @@ SUBMIND_INITIAL_PROMPT = """
     Respond with one of these options: research, question, action, and a message that explains your choice. Return json with fields "type" and "message".
 """
 
+SUBMIND_BATCH_PROMPT = """
+    Your job is to align your values with them as much as possible and help them out in any way you can.
+    
+    You have just received these thoughts from the founder, each prefixed with its id: 
+    
+    {thoughts}
+    
+    For each thought, based on that thought, your shared values, and your current state of mind, what do you think your next action should be?
+    
+    You can research something to find out more about it, ask a question to clarify something, or take an action to help the founder.
+    
+    Respond once per thought with its id, one of these options: research, question, action, and a message that explains your choice.
+"""
+
 
+def thought_batches(thoughts, token_budget=THOUGHT_BATCH_TOKENS):
+    batch = []
+    batch_tokens = 0
+    for thought in thoughts:
+        tokens = estimate_tokens(thought.content or "")
+        if batch and (batch_tokens + tokens > token_budget or len(batch) >= THOUGHT_BATCH_MAX):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(thought)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def _parse_batch_responses(message, thought_ids):
+    # Anything missing, malformed or for an unknown thought is left out and classified on its own
+    try:
+        responses = function_call_arguments(message, "responses")
+    except (KeyError, TypeError, ValueError):
+        return {}
+    reports = {}
+    for response in responses if isinstance(responses, list) else []:
+        if not isinstance(response, dict):
+            continue
+        thought_id = response.get("thoughtId")
+        if thought_id in thought_ids and response.get("responseType") in RESPONSE_TYPES \
+                and isinstance(response.get("message"), str):
+            reports.setdefault(thought_id, {"responseType": response["responseType"],
+                                            "message": response["message"]})
+    return reports
+
+
+def classify_thoughts(context, thoughts):
+    def build_chain(model):
+        return context_prompt(context, SUBMIND_INITIAL_PROMPT) | model.bind(function_call={"name": "respond_to_thought"},
+                                   functions=functions)
+
+    def build_batch_chain(model):
+        # Parsed outside the router so a bad batch falls back instead of counting against the model
+        return context_prompt(context, SUBMIND_BATCH_PROMPT) | model.bind(function_call={"name": "respond_to_thoughts"}, functions=batch_functions)
+
+    def classify_batch(thoughts_text):
+        try:
+            return router.invoke(CONTEXT_ROUTE, build_batch_chain, {"thoughts": thoughts_text})
+        except NoModelAvailable as e:
+            print(e)
+            return None
+
+    reports = {}
+    if THOUGHT_BATCH_TOKENS > 0:
+        batches = [batch for batch in thought_batches(thoughts) if len(batch) > 1]
+        messages = bounded_map(classify_batch, ["\n\n".join(f"[{thought.id}] {thought.content}" for thought in batch)
+                                                for batch in batches])
+        for batch, message in zip(batches, messages):
+            if message is None:
+                continue
+            batch_reports = _parse_batch_responses(message, {thought.id for thought in batch})
+            print(f"Classified {len(batch_reports)}/{len(batch)} thoughts in one call")
+            reports.update(batch_reports)
+
+    remaining = [thought for thought in thoughts if thought.id not in reports]
+    singles = bounded_map(lambda content: router.invoke(CONTEXT_ROUTE, build_chain, {"thought": content},
+                                                        parse=lambda message: function_call_arguments(message, "response")),
+                          [thought.content for thought in remaining])
+    reports.update((thought.id, report) for thought, report in zip(remaining, singles))
+    return reports
+
+
+def bounded_map(call, items):
+    # Runs model calls for up to THOUGHT_CONCURRENCY items at once, results in input order
+    if THOUGHT_CONCURRENCY < 2 or len(items) < 2:
+        return [call(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(THOUGHT_CONCURRENCY, len(items))) as pool:
+        return list(pool.map(call, items))
+
+
+@document_cache()
 def twitter_style_submind_run(submind, session):
-    founder = get_or_create_document(submind.ownerId, "You don't know anything about the founder yet",
-                                     submind.founderUUID if submind.founderUUID else str(uuid.uuid4()))
-    values = get_or_create_document(submind.ownerId, "You don't know anything about the founder's values yet",
-                                    submind.valuesUUID if submind.valuesUUID else str(uuid.uuid4()))
-    mind = get_or_create_document(submind.ownerId, "You don't know anything about the founder's mind yet",
-                                    submind.mindUUID if submind.mindUUID else str(uuid.uuid4()))
-
-    model = ChatOpenAI(model="gpt-4", openai_api_key=config("OPENAI_API_KEY"))
-    prompt = ChatPromptTemplate.from_template(SUBMIND_INITIAL_PROMPT)
-    chain = prompt | model.bind(function_call={"name": "respond_to_thought"},
-                                functions=functions) | JsonKeyOutputFunctionsParser(key_name="response")
-
-    for thought in submind.pendingThoughts:
+    context = load_submind_context(submind)
+
+    if LEASES_ENABLED:
+        pending_thoughts = claim_pending_thoughts(session, submind)
+    else:
+        pending_thoughts = list(submind.pendingThoughts)
+
+    reports = classify_thoughts(context, pending_thoughts)
+    # Research plans are model calls too; make them all up front and record them in queue order below
+    researching = [thought for thought in pending_thoughts if reports[thought.id]['responseType'] == "research"]
+    plans = dict(zip([thought.id for thought in researching],
+                     bounded_map(lambda item: plan_research(context, *item),
+                                 [(thought.content, reports[thought.id]['message']) for thought in researching])))
+
+    # Each thought's outputs and its removal from the queue are staged together and committed in
+    # batches, so a thought only leaves the queue in the same transaction that writes its outputs
+    unreleased = []
+
+    def flush():
+        if LEASES_ENABLED and unreleased:
+            release(session, *unreleased)
+        else:
+            session.commit()
+        unreleased.clear()
+
+    for staged, thought in enumerate(pending_thoughts, start=1):
         like = Like()
-        like.thoughtId = thought.id
+        like.thought = thought
         like.submindId = submind.id
         like.createdAt = datetime.now()
         session.add(like)
-        session.commit()
-
-        report = chain.invoke({
-            "founder": founder['content'],
-            "values": values['content'],
-            "mind": mind['content'],
-            "thought": thought.content
+        submind.pendingThoughts.remove(thought)
+        if LEASES_ENABLED:
+            unreleased.append(thought_resource(submind.id, thought.id))
 
-        })
+        report = reports[thought.id]
         print(report['responseType'])
         if report['responseType'] == "research":
-            start_research(submind, thought, report['message'], session)
+            # starts the searches now; the rows are committed with the rest of this thought's outputs
+            record_research(submind, thought, plans[thought.id], session)
 
         elif report['responseType'] == "question":
             # Ask a question
@@ -116,10 +256,9 @@ def twitter_style_submind_run(submind, session):
             new_thought.contextId = submind.contextId
             new_thought.uuid = str(uuid.uuid4())
             new_thought.createdAt = datetime.now()
-            new_thought.parentId = thought.id
+            new_thought.parent = thought
             new_thought.ownerId = submind.ownerId
             session.add(new_thought)
-            session.commit()
 
         elif report['responseType'] == "action":
             new_thought = Thought()
@@ -128,26 +267,23 @@ def twitter_style_submind_run(submind, session):
             new_thought.contextId = submind.contextId
             new_thought.uuid = str(uuid.uuid4())
             new_thought.createdAt = datetime.now()
-            new_thought.parentId = thought.id
+            new_thought.parent = thought
             new_thought.ownerId = submind.ownerId
             session.add(new_thought)
-            session.commit()
             task = Task()
             task.name = report['message']
             task.submindId = submind.id
             task.ownerId = submind.ownerId
             task.createdAt = datetime.now()
             task.updatedAt = datetime.now()
-            task.thoughtId = new_thought.id
+            task.thought = new_thought
             task.uuid = str(uuid.uuid4())
             session.add(task)
-            session.commit()
             # Take an action
 
-        submind.pendingThoughts.remove(thought)
-        session.add(submind)
-        session.commit()
-
+        if staged % THOUGHT_COMMIT_EVERY == 0:
+            flush()
+    flush()
 
     # {"type": "question", "message": "Could you please clarify what specific functionality or feature you would like to be implemented or improved in our application?"}
 
@@ -0,0 +1,99 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+
+from decouple import config
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_PATH = config('EMBEDDING_CACHE_PATH', default='embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_ENTRIES = config('EMBEDDING_CACHE_MAX_ENTRIES', default=50000, cast=int)
+
+_vectorstore = None
+_vectorstore_lock = threading.Lock()
+
+
+class CachedEmbeddings(Embeddings):
+    # Embeddings keyed by a hash of model and text, kept in sqlite across runs and evicted least recently used first
+    def __init__(self, embeddings, model_name, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL, lastUsed REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (lastUsed)")
+        self.connection.commit()
+
+    def _hash(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    def _lookup(self, hashes):
+        found = {}
+        unique = list(set(hashes))
+        with self.lock:
+            # stay well under sqlite's bound parameter limit
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+                found.update((key, array('d', vector).tolist()) for key, vector in rows)
+            now = time.time()
+            self.connection.executemany("UPDATE embeddings SET lastUsed = ? WHERE hash = ?",
+                                        [(now, key) for key in found])
+            self.connection.commit()
+        return found
+
+    def _store(self, vectors):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, vector, lastUsed) VALUES (?, ?, ?)",
+                [(key, array('d', vector).tobytes(), now) for key, vector in vectors.items()])
+            (count,) = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM embeddings WHERE hash IN (SELECT hash FROM embeddings ORDER BY lastUsed LIMIT ?)",
+                    (count - self.max_entries,))
+            self.connection.commit()
+
+    def embed_documents(self, texts):
+        hashes = [self._hash(text) for text in texts]
+        vectors = self._lookup(hashes)
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            embedded = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self._store(embedded)
+            vectors.update(embedded)
+        return [vectors[key] for key in hashes]
+
+    def embed_query(self, text):
+        key = self._hash(text)
+        cached = self._lookup([key])
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings.embed_query(text)
+        self._store({key: vector})
+        return vector
+
+
+def get_vectorstore():
+    # One Pinecone client, embeddings client and vector store per process
+    global _vectorstore
+    with _vectorstore_lock:
+        if _vectorstore is None:
+            from langchain.embeddings import OpenAIEmbeddings
+            from langchain_pinecone import PineconeVectorStore
+            from pinecone import Pinecone
+
+            pc = Pinecone(api_key=config("PINECONE_API_KEY"))
+            openai_embeddings = OpenAIEmbeddings(openai_api_key=config("OPENAI_API_KEY"))
+            embeddings = CachedEmbeddings(openai_embeddings, openai_embeddings.model)
+            index = pc.Index(config("PINECONE_INDEX_NAME"), host=config("PINECONE_HOST"))
+            _vectorstore = PineconeVectorStore(index, embeddings, "text", namespace=config('PINECONE_NAMESPACE'))
+        return _vectorstore
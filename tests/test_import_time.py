@@ -0,0 +1,40 @@
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+from decouple import config
+
+ROOT = Path(__file__).resolve().parent.parent
+# Cumulative import time of main, in seconds
+IMPORT_TIME_BUDGET_SECONDS = config('IMPORT_TIME_BUDGET_SECONDS', default=2.0, cast=float)
+HEAVY_MODULES = ("langchain", "pinecone", "anthropic", "openai")
+
+IMPORT_TIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+def import_main():
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                          capture_output=True, text=True, check=True, env={**os.environ, "PYTHONPATH": str(ROOT)})
+
+
+def imported_modules(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(2))
+    return modules
+
+
+def test_cold_start_skips_llm_integrations():
+    modules = imported_modules(import_main().stderr)
+    heavy = sorted(name for name in modules if name.split(".")[0].startswith(HEAVY_MODULES))
+    assert heavy == []
+
+
+def test_cold_start_within_budget():
+    modules = imported_modules(import_main().stderr)
+    seconds = modules["main"] / 1_000_000
+    assert seconds <= IMPORT_TIME_BUDGET_SECONDS, f"import main took {seconds:.2f}s"
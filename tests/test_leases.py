@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+from decouple import config
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from submind.leases import claim, lease_heartbeat, lease_owner, release, renew
+from submind.models import Lease
+
+# Needs a throwaway local Postgres, e.g. TEST_DATABASE_URL=postgresql://postgres@localhost/submind_test
+TEST_DATABASE_URL = config('TEST_DATABASE_URL', default=None)
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(TEST_DATABASE_URL)
+    Lease.__table__.create(engine, checkfirst=True)
+    yield engine
+    with Session(engine) as session:
+        session.query(Lease).filter(Lease.resource.like("test:%")).delete(synchronize_session=False)
+        session.commit()
+    engine.dispose()
+
+
+def in_other_thread(call):
+    # Lease owners are per thread, so another thread stands in for another worker or node
+    result = []
+    thread = threading.Thread(target=lambda: result.append(call()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def claim_elsewhere(engine, resource, ttl=60):
+    def call():
+        with Session(engine) as session:
+            return claim(session, resource, ttl)
+    return in_other_thread(call)
+
+
+def test_claim_is_exclusive_until_released(engine):
+    with Session(engine) as session:
+        assert claim(session, "test:exclusive", 60)
+        assert claim(session, "test:exclusive", 60)
+        assert not claim_elsewhere(engine, "test:exclusive")
+        release(session, "test:exclusive")
+    assert claim_elsewhere(engine, "test:exclusive")
+
+
+def test_expired_lease_can_be_taken_over(engine):
+    with Session(engine) as session:
+        assert claim(session, "test:expired", 1)
+    time.sleep(1.5)
+    assert claim_elsewhere(engine, "test:expired")
+
+
+def test_renew_extends_only_our_leases(engine):
+    with Session(engine) as session:
+        assert claim(session, "test:renewed", 1)
+        assert claim_elsewhere(engine, "test:theirs")
+        assert renew(session, ttl=60) >= 1
+        theirs = session.get(Lease, "test:theirs")
+        assert theirs.owner != lease_owner()
+    time.sleep(1.5)
+    assert not claim_elsewhere(engine, "test:renewed")
+
+
+def test_heartbeat_keeps_a_long_run_leased(engine):
+    with Session(engine) as session:
+        assert claim(session, "test:heartbeat", 1)
+        with lease_heartbeat(engine, interval=0.3, ttl=1):
+            time.sleep(2)
+            assert not claim_elsewhere(engine, "test:heartbeat")
+    time.sleep(1.5)
+    assert claim_elsewhere(engine, "test:heartbeat")
@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from submind import podcast_api
+
+ROUND_TRIP_SECONDS = 0.3
+
+
+class StubPodcastAPI(BaseHTTPRequestHandler):
+    # Scripted by the id or query in the request body, and counts how often each one was hit
+    hits = Counter()
+    lock = threading.Lock()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        key = payload.get('query_id') or payload.get('query')
+        with self.lock:
+            self.hits[key] += 1
+            hit = self.hits[key]
+
+        if key.startswith('slow'):
+            time.sleep(ROUND_TRIP_SECONDS)
+            return self.reply(200, {'status': 'complete', 'query_id': key})
+        if key == 'flaky-503' and hit == 1:
+            return self.reply(503, {'detail': 'unavailable'})
+        if key == 'flaky-429' and hit == 1:
+            return self.reply(429, {'detail': 'slow down'})
+        if key == 'bad-gateway':
+            return self.reply(502, {'detail': 'bad gateway'})
+        if key == 'unauthorized':
+            return self.reply(401, {'detail': 'invalid api key'})
+        if key == 'timeout':
+            time.sleep(1)
+        return self.reply(200, {'status': 'complete', 'query_id': key})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubPodcastAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('API_URL', f'http://127.0.0.1:{server.server_address[1]}/')
+    monkeypatch.setenv('API_KEY', 'test')
+    monkeypatch.setattr(podcast_api, '_session', None)
+    StubPodcastAPI.hits.clear()
+    yield StubPodcastAPI.hits
+    server.shutdown()
+    server.server_close()
+    podcast_api._session = None
+
+
+def test_query_statuses_polls_concurrently(stub_api):
+    query_ids = [f'slow-{index}' for index in range(8)]
+    started = time.monotonic()
+    statuses = podcast_api.query_statuses(query_ids)
+    elapsed = time.monotonic() - started
+
+    assert [statuses[query_id]['query_id'] for query_id in query_ids] == query_ids
+    assert elapsed < ROUND_TRIP_SECONDS * 3
+
+
+@pytest.mark.parametrize('query_id', ['flaky-503', 'flaky-429'])
+def test_query_status_retries_server_errors_and_rate_limits(stub_api, query_id):
+    assert podcast_api.query_status(query_id)['status'] == 'complete'
+    assert stub_api[query_id] == 2
+
+
+def test_find_is_not_retried_after_a_bad_gateway(stub_api):
+    assert podcast_api.find_many(['bad-gateway']) == [None]
+    assert stub_api['bad-gateway'] == 1
+
+
+def test_find_is_not_retried_after_a_read_timeout(stub_api, monkeypatch):
+    monkeypatch.setattr(podcast_api, 'PODCAST_API_TIMEOUT', 0.2)
+    assert podcast_api.find_many(['timeout']) == [None]
+    assert stub_api['timeout'] == 1
+
+
+def test_failing_id_does_not_sink_the_batch(stub_api):
+    statuses = podcast_api.query_statuses(['slow-ok', 'unauthorized'])
+    assert statuses['slow-ok']['status'] == 'complete'
+    assert statuses['unauthorized'] is None